@@ -1,8 +1,28 @@
 """
 Functions to write the x,y data to a tfrecord file
 """
+import json
+import os
+import tempfile
+import numpy as np
 import tensorflow as tf
 
+# Compression of the tfrecord files. These are uncompressed since inflating
+# every record was a large part of the CPU usage when loading data, and it
+# allows decoding in parallel without stalling. If disk space matters, use a
+# compressed filesystem (e.g. ZFS or btrfs with zstd) instead.
+TFRECORD_COMPRESSION = ""
+
+
+# Version of the record format, part of the filenames so that after the format
+# changes, files in the old format are regenerated rather than reused (the
+# generation skips files that already exist) and then failing to parse.
+#   1 - serialized x and y tensors (unversioned filenames)
+#   2 - raw float32 bytes of x and y plus the shape of x
+#   3 - uncompressed rather than GZIP
+#   4 - uint8 rather than float32 y
+TFRECORD_FORMAT_VERSION = 4
+
 
 def _bytes_feature(value):
     """ Returns a bytes_list from a string / byte. """
@@ -11,10 +31,25 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+def _int64_feature(values):
+    """ Returns an int64_list from a list of ints. """
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
 def create_tf_example(x, y):
+    """ Store the raw bytes of x (float32) and y (uint8, since it's a class
+    index) rather than serialized tensors so reading only requires
+    tf.io.decode_raw, plus the shape of x so we can reshape it after
+    decoding """
+    assert np.all((0 <= np.asarray(y)) & (np.asarray(y) < 256)), \
+        "class labels must fit in a uint8"
+    x = np.asarray(x, dtype=np.float32)
+    y = np.asarray(y, dtype=np.uint8)
+
     tf_example = tf.train.Example(features=tf.train.Features(feature={
-        'x': _bytes_feature(tf.io.serialize_tensor(x)),
-        'y': _bytes_feature(tf.io.serialize_tensor(y)),
+        'x': _bytes_feature(x.tobytes()),
+        'x_shape': _int64_feature(x.shape),
+        'y': _bytes_feature(y.tobytes()),
     }))
     return tf_example
 
@@ -22,14 +57,70 @@ def create_tf_example(x, y):
 def write_tfrecord(filename, x, y):
     """ Output to TF record file """
     assert len(x) == len(y)
-    options = tf.io.TFRecordOptions(compression_type="GZIP")
+    options = tf.io.TFRecordOptions(compression_type=TFRECORD_COMPRESSION)
 
     with tf.io.TFRecordWriter(filename, options=options) as writer:
         for i in range(len(x)):
             tf_example = create_tf_example(x[i], y[i])
             writer.write(tf_example.SerializeToString())
 
+    write_tfrecord_count(filename, len(x))
+
+
+def tfrecord_count_filename(filename):
+    """ Sidecar file with the number of examples in a tfrecord file, e.g.
+    ucihar_1_train.tfrecord.count """
+    return filename+".count"
+
+
+def write_tfrecord_count(filename, count):
+    """ Save the number of examples in the tfrecord file
+
+    Write to a temporary file in the same directory and then rename it, so
+    other jobs reading it at the same time never see a partially-written file.
+    """
+    count_filename = tfrecord_count_filename(filename)
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(count_filename)),
+        prefix=os.path.basename(count_filename)+".", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"count": count}, f)
+        os.replace(tmp_filename, count_filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def count_tfrecord(filename):
+    """ Number of examples in the tfrecord file, read from the sidecar file if
+    it exists. Otherwise, count the records (without parsing them) and try to
+    write the sidecar file so next time we don't have to. """
+    count_filename = tfrecord_count_filename(filename)
+
+    # If it's not valid (e.g. written by an older version), count instead
+    if os.path.exists(count_filename):
+        try:
+            with open(count_filename) as f:
+                return json.load(f)["count"]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    count = sum(1 for _ in tf.data.TFRecordDataset(filename,
+        compression_type=TFRECORD_COMPRESSION))
+
+    # Saving the count is only an optimization, so if we can't (e.g. the
+    # directory is read-only), still return the count
+    try:
+        write_tfrecord_count(filename, count)
+    except OSError:
+        pass
+
+    return count
+
 
 def tfrecord_filename(dataset_name, postfix):
-    """ Filename for tfrecord files, e.g. ucihar_1_train.tfrecord """
-    return "%s_%s.tfrecord"%(dataset_name, postfix)
+    """ Filename for tfrecord files, e.g. ucihar_1_train.v4.tfrecord """
+    return "%s_%s.v%d.tfrecord"%(dataset_name, postfix,
+        TFRECORD_FORMAT_VERSION)
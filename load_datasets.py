@@ -1,6 +1,9 @@
 """
 Datasets
 """
+import functools
+import glob
+import hashlib
 import os
 import tensorflow as tf
 
@@ -8,7 +11,8 @@ from absl import app
 from absl import flags
 
 from datasets import datasets
-from datasets.tfrecord import tfrecord_filename
+from datasets.tfrecord import tfrecord_filename, count_tfrecord, \
+    TFRECORD_COMPRESSION
 
 FLAGS = flags.FLAGS
 
@@ -16,8 +20,7 @@ flags.DEFINE_integer("train_batch", 128, "Batch size for training")
 flags.DEFINE_integer("eval_batch", 2048, "Batch size for evaluation")
 flags.DEFINE_enum("batch_division", "all", ["none", "sources", "all"], "Batch size options (e.g. 32): none - 32 for each source and target; sources - 32/n for n sources, 32 for target; all - 32/(n+1) for n sources and 1 target")
 flags.DEFINE_integer("shuffle_buffer", 60000, "Dataset shuffle buffer size")
-flags.DEFINE_integer("prefetch_buffer", 1, "Dataset prefetch buffer size (0 = autotune)")
-flags.DEFINE_boolean("tune_num_parallel_calls", False, "Autotune num_parallel_calls")
+flags.DEFINE_integer("prefetch_buffer", 2, "Dataset prefetch buffer size in batches (0 = no prefetching)")
 flags.DEFINE_integer("eval_shuffle_seed", 0, "Evaluation shuffle seed for repeatability")
 flags.DEFINE_integer("train_max_examples", 0, "Max number of examples to use for training (default 0, i.e. all)")
 flags.DEFINE_integer("max_target_examples", 0, "Max number of target examples to use during training (default 0, i.e. all; overrides train_max_examples for target)")
@@ -26,7 +29,69 @@ flags.DEFINE_integer("trim_time_steps", 0, "For testing RNN vs. CNN handling var
 flags.DEFINE_integer("trim_features", 0, "For testing RNN vs. CNN handling varying numbers of features, allow only using the first n features (default 0, i.e. all the features)")
 flags.DEFINE_string("source_feature_subset", "", "Comma-separated zero-indexed integer list of which features (and in which order) to use for the source domain (default blank, i.e. all the features)")
 flags.DEFINE_string("target_feature_subset", "", "Comma-separated zero-indexed integer list of which features (and in which order) to use for the target domain (default blank, i.e. all the features)")
-flags.DEFINE_boolean("cache", True, "Cache datasets in memory to reduce filesystem usage")
+flags.DEFINE_boolean("cache", True, "Cache datasets in memory to reduce filesystem usage (evaluation datasets are always cached)")
+flags.DEFINE_string("cache_dir", "", "Directory to cache parsed datasets in rather than memory, for datasets too large for RAM (default blank, i.e. in memory)")
+
+
+# Create a description of the features
+# See: https://www.tensorflow.org/tutorials/load_data/tf-records
+feature_description = {
+    'x': tf.io.FixedLenFeature([], tf.string),
+    'x_shape': tf.io.VarLenFeature(tf.int64),
+    'y': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def parse_example_batch(example_protos, trim_time_steps=0, trim_features=0,
+        feature_subset=None):
+    """
+    Parse a batch of input tf.Example protos using the dictionary above.
+    parse_single_example is without a batch, parse_example is with
+    batches, so we batch the serialized examples first and parse the
+    whole batch at once rather than one example at a time.
+
+    What's parsed returns byte strings, but really we want to get the
+    float32 x and uint8 y tensors back that we stored the raw bytes of
+    earlier, so also run tf.io.decode_raw on the whole batch and reshape x
+    back to its original shape. The labels are kept as uint8 in the
+    pipeline (e.g. in the cache and shuffle buffer) and only cast when
+    training/evaluating (see MethodBase.get_next_batch_single).
+
+    Optionally trim the time steps or features or select a subset of the
+    features (if not 0 or None). Pass these as constants (e.g. with
+    functools.partial) so they're fixed when tf.data traces this function.
+    """
+    parsed = tf.io.parse_example(serialized=example_protos,
+        features=feature_description)
+
+    # All the examples have the same shape, so use the first's
+    x_shape = tf.sparse.to_dense(parsed["x_shape"])[0]
+    x = tf.io.decode_raw(parsed["x"], tf.float32)
+    x = tf.reshape(x, tf.concat([
+        tf.constant([-1], dtype=tf.int64), x_shape], axis=0))
+    y = tf.io.decode_raw(parsed["y"], tf.uint8)
+    y = tf.reshape(y, [-1])
+
+    # Trim to certain time series length and/or to a certain number of
+    # features (the first n = trim_features), done on the whole batch at once
+    # shape before: [batch_size, time_steps, features]
+    # shape after:  [batch_size, min(time_steps, trim_time_steps),
+    #                min(features, trim_features)]
+    #
+    # Note: Python slicing gives a single strided slice with constant bounds
+    # and already clamps to the dimension size, so no tf.minimum needed. None
+    # keeps the whole dimension.
+    if trim_time_steps != 0 or trim_features != 0:
+        time_steps = trim_time_steps if trim_time_steps != 0 else None
+        features = trim_features if trim_features != 0 else None
+        x = x[:, :time_steps, :features]
+
+    # Select only the desired features, if specified
+    if feature_subset is not None:
+        # axis=-1 is the feature dimension
+        x = tf.gather(x, feature_subset, axis=-1)
+
+    return x, y
 
 
 class Dataset:
@@ -35,15 +100,18 @@ class Dataset:
             train_filenames, test_filenames,
             train_batch=None, eval_batch=None,
             shuffle_buffer=None, prefetch_buffer=None,
-            eval_shuffle_seed=None, cache=None,
-            train_max_examples=None, eval_max_examples=None,
-            tune_num_parallel_calls=None, feature_subset=None):
+            eval_shuffle_seed=None, cache=None, cache_dir=None,
+            cache_key="", train_max_examples=None, eval_max_examples=None,
+            feature_subset=None):
         """
         Initialize dataset
 
         Must specify num_classes and class_labels (the names of the classes).
         Other arguments if None are defaults from command line flags.
 
+        cache_key should be specific to the run (e.g. the log dir), so that
+        concurrent runs caching to the same cache_dir use different files.
+
         For example:
             Dataset(num_classes=2, class_labels=["class1", "class2"])
         """
@@ -61,9 +129,10 @@ class Dataset:
         self.prefetch_buffer = prefetch_buffer
         self.eval_shuffle_seed = eval_shuffle_seed
         self.cache = cache
+        self.cache_dir = cache_dir
+        self.cache_key = cache_key
         self.eval_max_examples = eval_max_examples
         self.train_max_examples = train_max_examples
-        self.tune_num_parallel_calls = tune_num_parallel_calls
         self.feature_subset = feature_subset
 
         # Set defaults if not specified
@@ -79,129 +148,236 @@ class Dataset:
             self.eval_shuffle_seed = FLAGS.eval_shuffle_seed
         if self.cache is None:
             self.cache = FLAGS.cache
+        if self.cache_dir is None:
+            self.cache_dir = FLAGS.cache_dir
         if self.eval_max_examples is None:
             self.eval_max_examples = FLAGS.eval_max_examples
         if self.train_max_examples is None:
             self.train_max_examples = FLAGS.train_max_examples
-        if self.tune_num_parallel_calls is None:
-            self.tune_num_parallel_calls = FLAGS.tune_num_parallel_calls
 
-        # Load the dataset
-        self.train, self.train_evaluation, self.test_evaluation = \
-            self.load_dataset(train_filenames, test_filenames)
+        # Load the dataset, unless there's nothing to load (e.g. the files for
+        # this dataset weren't generated)
+        if len(train_filenames) == 0 and len(test_filenames) == 0:
+            self.train = None
+            self.train_evaluation = None
+            self.test_evaluation = None
+        else:
+            self.train, self.train_evaluation, self.test_evaluation = \
+                self.load_dataset(train_filenames, test_filenames)
+
+    def parse_function(self):
+        """ Function to parse batches of examples for this dataset. The
+        trimming and feature subset are constant for the whole run, so fix them
+        in the parse function when building the pipeline. """
+        if self.feature_subset is not None:
+            assert FLAGS.trim_features == 0, \
+                "cannot specify both {source,target}_feature_subset and trim_features"
+
+        return functools.partial(parse_example_batch,
+            trim_time_steps=FLAGS.trim_time_steps,
+            trim_features=FLAGS.trim_features,
+            feature_subset=self.feature_subset)
+
+    def read_tfrecords(self, filenames, max_examples):
+        """ Read the (unparsed) records from the .tfrecord files, only the
+        first max_examples if not 0 """
+        # Interleave the tfrecord files, reading (and decompressing) them in
+        # parallel. If only taking the first max_examples examples, read one
+        # file per thread instead, so we don't read ahead and decompress many
+        # records that take() will drop.
+        if max_examples != 0:
+            num_parallel_reads = len(filenames)
+        else:
+            num_parallel_reads = tf.data.experimental.AUTOTUNE
+
+        dataset = tf.data.TFRecordDataset(filenames,
+            compression_type=TFRECORD_COMPRESSION,
+            buffer_size=8*1024*1024, num_parallel_reads=num_parallel_reads)
 
-    def load_tfrecords(self, filenames, batch_size, count=False, evaluation=False):
+        # If desired, take the first max_examples examples. Note: this is the
+        # first so-many examples, but we shuffled before putting into the
+        # tfrecord file (train_test_split in datasets.py), so it is a random set
+        # essentially. We do this so we consistently use the same data between
+        # runs. This is done before parsing, so only the kept examples are
+        # parsed.
+        if max_examples != 0:
+            dataset = dataset.take(max_examples)
+
+        return dataset
+
+    def load_parsed_tfrecords(self, filenames, batch_size, max_examples,
+            evaluation):
+        """ Read, parse, and cache the examples from the .tfrecord files. Parse
+        in batches, then unbatch so we can still shuffle individual examples.
+
+        For training, let parsed batches be output as soon as they're done
+        rather than in order. This is after take(), so it doesn't change which
+        examples are used, and training shuffles them anyway.
+        """
+        dataset = self.read_tfrecords(filenames, max_examples)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(self.parse_function(),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+            deterministic=evaluation)
+        dataset = dataset.unbatch()
+        dataset = dataset.cache(self.cache_filename(filenames, evaluation,
+            max_examples))
+
+        return dataset
+
+    def load_tfrecords(self, filenames, batch_size, count=False,
+            evaluation=False, parsed=None):
         """
         Load data from .tfrecord files (requires less memory but more disk space)
+
+        If count=True, then instead return the number of examples. If parsed is
+        given (from load_parsed_tfrecords), then use those already-parsed
+        examples rather than reading the files again.
         """
         if len(filenames) == 0:
             return None
 
-        # Create a description of the features
-        # See: https://www.tensorflow.org/tutorials/load_data/tf-records
-        feature_description = {
-            'x': tf.io.FixedLenFeature([], tf.string),
-            'y': tf.io.FixedLenFeature([], tf.string),
-        }
-
-        def _parse_example_function(example_proto):
-            """
-            Parse the input tf.Example proto using the dictionary above.
-            parse_single_example is without a batch, parse_example is with batches
-
-            What's parsed returns byte strings, but really we want to get the
-            tensors back that we encoded with tf.io.serialize_tensor() earlier,
-            so also run tf.io.parse_tensor
-            """
-            parsed = tf.io.parse_single_example(serialized=example_proto,
-                features=feature_description)
-
-            x = tf.io.parse_tensor(parsed["x"], tf.float32)
-            y = tf.io.parse_tensor(parsed["y"], tf.float32)
-
-            # Trim to certain time series length (note single example, not batch)
-            # shape before: [time_steps, features]
-            # shape after:  [min(time_steps, trim_time_steps), features]
-            if FLAGS.trim_time_steps != 0:
-                x = tf.slice(x, [0, 0],
-                    [tf.minimum(tf.shape(x)[0], FLAGS.trim_time_steps), tf.shape(x)[1]])
-
-            # Trim to a certain number of features (the first n = trim_features)
-            if FLAGS.trim_features != 0:
-                x = tf.slice(x, [0, 0],
-                    [tf.shape(x)[0], tf.minimum(tf.shape(x)[1], FLAGS.trim_features)])
-
-            # Select only the desired features, if specified
-            if self.feature_subset is not None:
-                assert FLAGS.trim_features == 0, \
-                    "cannot specify both {source,target}_feature_subset and trim_features"
-                # axis=-1 is the feature dimension
-                x = tf.gather(x, self.feature_subset, axis=-1)
-
-            return x, y
-
-        # Interleave the tfrecord files
-        files = tf.data.Dataset.from_tensor_slices(filenames)
-        dataset = files.interleave(
-            lambda x: tf.data.TFRecordDataset(x, compression_type='GZIP').prefetch(100),
-            cycle_length=len(filenames), block_length=1)
-
-        # If desired, take the first max_examples examples. Note: this is the
-        # first so-many examples, but we shuffled before putting into the
-        # tfrecord file (train_test_split in datasets.py), so it is a random set
-        # essentially. We do this so we consistently use the same data between
-        # runs.
+        # If desired, take the first max_examples examples (see below)
         if evaluation:
-            if self.eval_max_examples != 0:
-                dataset = dataset.take(self.eval_max_examples)
+            max_examples = self.eval_max_examples
         else:
-            if self.train_max_examples != 0:
-                dataset = dataset.take(self.train_max_examples)
+            max_examples = self.train_max_examples
+
+        # Counting doesn't require loading the data, just the sidecar files
+        # with the number of examples in each tfrecord file
+        if count:
+            num_examples = sum(count_tfrecord(f) for f in filenames)
+
+            if max_examples != 0:
+                num_examples = min(num_examples, max_examples)
 
-        # Whether to do autotuning of prefetch or num_parallel_calls
-        prefetch_buffer = self.prefetch_buffer
-        num_parallel_calls = None
-        if self.tune_num_parallel_calls:
-            num_parallel_calls = tf.data.experimental.AUTOTUNE
-        if self.prefetch_buffer == 0:
-            prefetch_buffer = tf.data.experimental.AUTOTUNE
+            return num_examples
 
         # Use .cache() or .cache(filename) to reduce loading over the network
         # https://www.tensorflow.org/guide/data_performance#map_and_cache
         # Example: https://www.tensorflow.org/tutorials/load_data/images
-        if self.cache:
+        #
+        # The evaluation datasets are always cached since they're finite and
+        # we iterate over them in their entirety every evaluation.
+        cache = self.cache or evaluation
+
+        if cache:
             # Map before caching so we don't have to keep doing this over and over
-            # again -- drastically reduces CPU usage.
-            dataset = dataset.map(_parse_example_function,
-                num_parallel_calls=num_parallel_calls)
+            # again -- drastically reduces CPU usage. If given, use the already
+            # parsed and cached examples (shared with another dataset).
+            if parsed is None:
+                parsed = self.load_parsed_tfrecords(filenames, batch_size,
+                    max_examples, evaluation)
 
-            dataset = dataset.cache()
+            dataset = parsed
+        else:
+            dataset = self.read_tfrecords(filenames, max_examples)
 
-        if count:  # only count, so no need to shuffle
-            pass
-        elif evaluation:  # don't repeat since we want to evaluate entire set
-            dataset = dataset.shuffle(self.shuffle_buffer, seed=self.eval_shuffle_seed)
-        else:  # repeat and shuffle
-            dataset = dataset.shuffle(self.shuffle_buffer).repeat()
+        # No need for a shuffle buffer larger than the number of examples,
+        # which would just waste memory
+        shuffle_buffer = max(1, min(self.shuffle_buffer, self.load_tfrecords(
+            filenames, batch_size, count=True, evaluation=evaluation)))
 
-        # If not caching, then it's faster to map right next to batch
-        if not self.cache:
-            dataset = dataset.map(_parse_example_function,
-                num_parallel_calls=num_parallel_calls)
+        if evaluation:  # don't repeat since we want to evaluate entire set
+            dataset = dataset.shuffle(shuffle_buffer, seed=self.eval_shuffle_seed)
+        else:  # repeat and shuffle
+            # Fused, so shuffling the next epoch overlaps with the current one
+            dataset = dataset.apply(
+                tf.data.experimental.shuffle_and_repeat(shuffle_buffer))
 
         dataset = dataset.batch(batch_size)
-        dataset = dataset.prefetch(prefetch_buffer)
+
+        # If not caching, then it's faster to parse right after the batch
+        if not cache:
+            dataset = dataset.map(self.parse_function(),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                deterministic=evaluation)
+
+        # Prefetch a fixed small number of batches. Autotuning the prefetch
+        # buffer size can pick pathologically large values (running out of
+        # memory) without being any faster.
+        if self.prefetch_buffer != 0:
+            dataset = dataset.prefetch(self.prefetch_buffer)
+
+        # Enable tf.data's static optimizations, which rewrite the pipeline,
+        # e.g. fusing adjacent map and batch or shuffle and repeat ops
+        options = tf.data.Options()
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.map_fusion = True
+        options.experimental_optimization.noop_elimination = True
+        options.experimental_optimization.shuffle_and_repeat_fusion = True
+        options.experimental_optimization.parallel_batch = True
+        options.experimental_optimization.map_vectorization.enabled = True
+
+        # There's a pipeline for each domain, so split the cores between them
+        # rather than all contending for the same threads. Only count the cores
+        # we're allowed to run on (e.g. those SLURM gave this job), not all of
+        # the node's cores.
+        num_cores = len(os.sched_getaffinity(0))
+        options.experimental_threading.private_threadpool_size = \
+            max(2, num_cores // max(1, self.num_domains))
+        options.experimental_threading.max_intra_op_parallelism = 1
+
+        # Allow outputting examples out of order for training, except when
+        # taking the first max_examples examples since then we want the same
+        # examples between runs. Evaluation stays deterministic for
+        # repeatability.
+        options.experimental_deterministic = evaluation or max_examples != 0
+
+        dataset = dataset.with_options(options)
 
         return dataset
 
+    def cache_filename(self, filenames, evaluation, max_examples):
+        """
+        Filename to cache the parsed dataset in if cache_dir is specified,
+        otherwise "" to cache in memory
+
+        The name depends on the run (cache_key) and everything that affects
+        what is cached, i.e. which files, how many examples, and any trimming
+        or feature selection.
+        """
+        if self.cache_dir == "":
+            return ""
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        key = str((self.cache_key, filenames, evaluation, max_examples,
+            FLAGS.trim_time_steps, FLAGS.trim_features, self.feature_subset))
+        name = os.path.join(self.cache_dir,
+            hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+        # Only this run uses these cache files, so a lockfile left over is from
+        # a previous attempt at this run that was killed while writing the
+        # cache. Remove it, otherwise tf.data refuses to write the cache.
+        for lockfile in glob.glob(glob.escape(name)+"_*.lockfile"):
+            try:
+                os.remove(lockfile)
+            except FileNotFoundError:
+                pass
+
+        return name
+
     def load_dataset(self, train_filenames, test_filenames):
         """
         Load the X dataset as a tf.data.Dataset from train/test tfrecord filenames
         """
+        # If the training and evaluation datasets use the same training
+        # examples, then only read and parse them once, sharing the cached
+        # examples between the two. Only do this when caching in memory since
+        # file caches can't be written by two iterators at once.
+        train_parsed = None
+
+        if len(train_filenames) > 0 and self.cache and self.cache_dir == "" \
+                and self.train_max_examples == self.eval_max_examples:
+            train_parsed = self.load_parsed_tfrecords(train_filenames,
+                self.eval_batch, self.eval_max_examples, evaluation=True)
+
         train_dataset = self.load_tfrecords(
-            train_filenames, self.train_batch)
+            train_filenames, self.train_batch, parsed=train_parsed)
         eval_train_dataset = self.load_tfrecords(
-            train_filenames, self.eval_batch, evaluation=True)
+            train_filenames, self.eval_batch, evaluation=True,
+            parsed=train_parsed)
         eval_test_dataset = self.load_tfrecords(
             test_filenames, self.eval_batch, evaluation=True)
 
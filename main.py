@@ -44,6 +44,8 @@ flags.DEFINE_boolean("debug", False, "Start new log/model/images rather than con
 flags.DEFINE_boolean("time_training", False, "Print how long each step takes, instead of every 100 steps")
 flags.DEFINE_boolean("moving_average", False, "Whether to use an exponential moving average of the weights rather than the weights directly (requires tensorflow_addons)")
 flags.DEFINE_boolean("share_most_weights", False, "Instead of regularizing weights in heterogeneous domain adaptation, share same-shape weights")
+flags.DEFINE_boolean("xla", False, "Compile clusters of ops in the model with XLA, fusing e.g. batch norm and activations into fewer kernels")
+flags.DEFINE_enum("policy", "float32", ["float32", "mixed_float16", "mixed_bfloat16"], "Keras dtype policy, i.e. whether to use mixed precision (mixed_float16 for GPUs with Tensor Cores, mixed_bfloat16 for TPUs or Ampere GPUs; vrada requires float32)")
 flags.DEFINE_integer("debugnum", -1, "Specify exact log/model/images number to use rather than incrementing from last. (Don't pass both this and --debug at the same time.)")
 
 flags.mark_flag_as_required("method")
@@ -89,6 +91,20 @@ def main(argv):
     # Allow running multiple at once
     set_gpu_memory(FLAGS.gpumem)
 
+    # XLA auto-clustering, which compiles the parts of the tf.function-compiled
+    # train step that XLA supports
+    if FLAGS.xla:
+        tf.config.optimizer.set_jit(True)
+
+    # Mixed precision -- must be set before creating the models. The VRNN and
+    # its loss (for VRADA) mix float32 inputs with the model's outputs, so
+    # only support float32 for it.
+    assert FLAGS.policy == "float32" or FLAGS.method != "vrada", \
+        "vrada method only supports --policy=float32"
+
+    if FLAGS.policy != "float32":
+        tf.keras.mixed_precision.experimental.set_policy(FLAGS.policy)
+
     # Figure out the log and model directory filenames
     assert FLAGS.uid != "", "uid cannot be an empty string"
     model_dir, log_dir = get_directory_names()
@@ -103,7 +119,7 @@ def main(argv):
 
     # Load datasets
     source_datasets, target_dataset = load_datasets.load_da(FLAGS.dataset,
-        FLAGS.sources, FLAGS.target, test=FLAGS.test)
+        FLAGS.sources, FLAGS.target, test=FLAGS.test, cache_key=log_dir)
 
     # Need to know which iteration for learning rate schedule
     global_step = tf.Variable(0, name="global_step", trainable=False)
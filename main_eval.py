@@ -140,7 +140,7 @@ def process_model(log_dir, model_dir, config, gpumem, multi_gpu):
 
     # Load datasets
     source_datasets, target_dataset = load_datasets.load_da(dataset_name,
-        sources, target, test=FLAGS.test)
+        sources, target, test=FLAGS.test, cache_key="eval "+log_dir)
 
     # Load the method, model, etc.
     # Note: {global,num}_step are for training, so it doesn't matter what
@@ -134,6 +134,13 @@ class MethodBase:
         if self.moving_average:
             opt = tfa.optimizers.MovingAverage(opt)
 
+        # float16 gradients may underflow, so scale the loss (see gradient())
+        policy = tf.keras.mixed_precision.experimental.global_policy()
+
+        if policy.name == "mixed_float16":
+            opt = tf.keras.mixed_precision.experimental.LossScaleOptimizer(
+                opt, "dynamic")
+
         return opt
 
     def create_optimizers(self):
@@ -168,7 +175,10 @@ class MethodBase:
         else:
             return index+1
 
-    @tf.function
+    # Relax shapes so if the batch size varies (e.g. depending on how the
+    # batch is divided between domains), then it generalizes to an unknown
+    # batch size rather than retracing for every new size
+    @tf.function(experimental_relax_shapes=True)
     def get_next_batch_both(self, data_sources, data_target):
         """ Compile for training. Don't for evaluation (called directly,
         not this _both function). """
@@ -198,6 +208,8 @@ class MethodBase:
         ds = []
 
         for i, (x, y) in enumerate(data):
+            # Labels are uint8 in the input pipeline to save memory
+            y = tf.cast(y, tf.float32)
             xs.append(x)
             ys.append(y)
             ds.append(tf.ones_like(y)*self.domain_label(index=i,
@@ -223,6 +235,8 @@ class MethodBase:
             "only support one target at present"
 
         x, y = data
+        # Labels are uint8 in the input pipeline to save memory
+        y = tf.cast(y, tf.float32)
         d = tf.ones_like(y)*self.domain_label(index=index, is_target=is_target)
         data_target = (x, y, d)
 
@@ -271,6 +285,11 @@ class MethodBase:
         domain_y_pred = tf.nn.softmax(domain_y_pred)
         return task_y_true, task_y_pred, domain_y_true, domain_y_pred
 
+    def train_model_kwargs(self):
+        """ Additional arguments passed to the model during training, e.g.
+        values that only need to be computed once per training step """
+        return {}
+
     def call_model(self, x, which_model, is_target=None, **kwargs):
         return self.model[which_model](x, **kwargs)
 
@@ -279,9 +298,23 @@ class MethodBase:
         # Maybe: regularization = sum(model.losses) and add to loss
         return self.task_loss(task_y_true, task_y_pred)
 
+    def gradient(self, tape, loss, variables, opt):
+        """ tape.gradient() but if opt is a LossScaleOptimizer (with the
+        mixed_float16 policy), then scale the loss before computing the
+        gradients and unscale them afterwards. The tape may no longer be
+        recording, so scale via the initial gradient (output_gradients)
+        rather than multiplying the loss. """
+        if isinstance(opt, tf.keras.mixed_precision.experimental.LossScaleOptimizer):
+            grad = tape.gradient(loss, variables,
+                output_gradients=opt.get_scaled_loss(tf.ones_like(loss)))
+            return opt.get_unscaled_gradients(grad)
+
+        return tape.gradient(loss, variables)
+
     def compute_gradients(self, tape, loss, which_model):
-        return tape.gradient(loss,
-            self.model[which_model].trainable_variables_task_fe)
+        return self.gradient(tape, loss,
+            self.model[which_model].trainable_variables_task_fe,
+            self.opt[which_model]["opt"])
 
     def apply_gradients(self, grad, which_model):
         self.opt[which_model]["opt"].apply_gradients(zip(grad,
@@ -319,7 +352,7 @@ class MethodBase:
         # evaluation metrics that much.
         return all_data_sources[0], all_data_target[0]
 
-    @tf.function
+    @tf.function(experimental_relax_shapes=True)  # see get_next_batch_both
     def _train_step(self, all_data_sources, all_data_target):
         """ The compiled part of train_step. We can't compile everything since
         some parts of the model need to know the shape of the data apparently.
@@ -327,6 +360,9 @@ class MethodBase:
         The first batch is passed in because to compile this, TF needs to know
         the shape. Doesn't look pretty... but it runs...
         """
+        # Computed once per step, shared by all the models in the ensemble
+        model_kwargs = self.train_model_kwargs()
+
         for i in range(self.ensemble_size):
             # Get random batch for this model in the ensemble (either same for
             # all or different for each)
@@ -344,7 +380,7 @@ class MethodBase:
             # Run batch through the model and compute loss
             with tf.GradientTape(persistent=True) as tape:
                 task_y_pred, domain_y_pred, fe_output = self.call_model(
-                    x, which_model=i, training=True)
+                    x, which_model=i, training=True, **model_kwargs)
                 losses = self.compute_losses(x, task_y_true, domain_y_true,
                     task_y_pred, domain_y_pred, fe_output, which_model=i,
                     training=True)
@@ -478,6 +514,7 @@ class MethodDann(MethodBase):
             global_step, total_steps, *args, **kwargs):
         self.global_step = global_step  # should be TF variable
         self.total_steps = total_steps
+        self.grl_schedule = models.DannGrlSchedule(self.total_steps)
         super().__init__(source_datasets, target_dataset, *args, **kwargs)
         self.loss_names += ["task", "domain"]
 
@@ -485,6 +522,13 @@ class MethodDann(MethodBase):
         return models.DannModel(self.num_classes, self.domain_outputs,
             self.global_step, self.total_steps, model_name=model_name)
 
+    def train_model_kwargs(self):
+        """ Compute the GRL schedule once per training step rather than in
+        each model (e.g. each model in the ensemble) """
+        kwargs = super().train_model_kwargs()
+        kwargs["grl_lambda"] = self.grl_schedule(self.global_step)
+        return kwargs
+
     def create_optimizers(self):
         opt = super().create_optimizers()
         # We need an additional optimizer for DANN
@@ -497,6 +541,8 @@ class MethodDann(MethodBase):
         # single-source, then the domain classifier may be sigmoid not softmax
         super().create_losses()
         self.domain_loss = make_loss()
+        # Task loss only on the source data (not target)
+        self.masked_task_loss = make_masked_loss()
 
     def prepare_data(self, data_sources, data_target):
         assert data_target is not None, "cannot run DANN without target"
@@ -519,21 +565,22 @@ class MethodDann(MethodBase):
 
     def compute_losses(self, x, task_y_true, domain_y_true, task_y_pred,
             domain_y_pred, fe_output, which_model, training):
-        nontarget = tf.where(tf.not_equal(domain_y_true, 0))
-        task_y_true = tf.gather(task_y_true, nontarget)
-        task_y_pred = tf.gather(task_y_pred, nontarget)
-
-        task_loss = self.task_loss(task_y_true, task_y_pred)
+        # Mask rather than gather the non-target examples, so the shapes don't
+        # depend on the number of target examples
+        nontarget = tf.not_equal(domain_y_true, 0)
+        task_loss = self.masked_task_loss(task_y_true, task_y_pred, nontarget)
         d_loss = self.domain_loss(domain_y_true, domain_y_pred)
         total_loss = task_loss + d_loss
         return [total_loss, task_loss, d_loss]
 
     def compute_gradients(self, tape, losses, which_model):
         total_loss, task_loss, d_loss = losses
-        grad = tape.gradient(total_loss,
-            self.model[which_model].trainable_variables_task_fe_domain)
-        d_grad = tape.gradient(d_loss,
-            self.model[which_model].trainable_variables_domain)
+        grad = self.gradient(tape, total_loss,
+            self.model[which_model].trainable_variables_task_fe_domain,
+            self.opt[which_model]["opt"])
+        d_grad = self.gradient(tape, d_loss,
+            self.model[which_model].trainable_variables_domain,
+            self.opt[which_model]["d_opt"])
         return [grad, d_grad]
 
     def apply_gradients(self, gradients, which_model):
@@ -663,13 +710,12 @@ class MethodDannSmooth(MethodDannGS):
 
         for i in range(len(task_y_true)):
             # For task loss, ignore target data
-            nontarget = tf.where(tf.not_equal(domain_y_true[i], 0))
-            i_task_y_true = tf.gather(task_y_true[i], nontarget)
-            i_task_y_pred = tf.gather(task_y_pred[i], nontarget)
+            nontarget = tf.not_equal(domain_y_true[i], 0)
 
             # Their code does nll_loss(log_softmax(...)) which should be
             # equivalent to cross entropy
-            task_losses.append(self.task_loss(i_task_y_true, i_task_y_pred))
+            task_losses.append(self.masked_task_loss(task_y_true[i],
+                task_y_pred[i], nontarget))
             domain_losses.append(self.domain_loss(domain_y_true[i], domain_y_pred[i]))
 
         # Defaults were 10.0 and 1e-2, which appear to do about the same as the
@@ -694,8 +740,9 @@ class MethodDannSmooth(MethodDannGS):
 
     def compute_gradients(self, tape, losses, which_model):
         """ We have one loss, update everything with it """
-        return tape.gradient(losses,
-            self.model[which_model].trainable_variables_task_fe_domain)
+        return self.gradient(tape, losses,
+            self.model[which_model].trainable_variables_task_fe_domain,
+            self.opt[which_model]["opt"])
 
     def apply_gradients(self, gradients, which_model):
         self.opt[which_model]["opt"].apply_gradients(zip(gradients,
@@ -775,8 +822,6 @@ class MethodDaws(MethodDann):
         super().__init__(*args, **kwargs)
         self.loss_names += ["weak"]
         self.compute_p_y()
-        # Used in loss
-        self.grl_schedule = models.DannGrlSchedule(self.total_steps)
 
     def compute_p_y(self):
         """ Compute P(y) (i.e. class balance) of the training target dataset
@@ -796,11 +841,8 @@ class MethodDaws(MethodDann):
     def compute_losses(self, x, task_y_true, domain_y_true, task_y_pred,
             domain_y_pred, fe_output, which_model, training):
         # DANN losses
-        nontarget = tf.where(tf.not_equal(domain_y_true, 0))
-        task_y_true_nontarget = tf.gather(task_y_true, nontarget)
-        task_y_pred_nontarget = tf.gather(task_y_pred, nontarget)
-
-        task_loss = self.task_loss(task_y_true_nontarget, task_y_pred_nontarget)
+        nontarget = tf.not_equal(domain_y_true, 0)
+        task_loss = self.masked_task_loss(task_y_true, task_y_pred, nontarget)
         d_loss = self.domain_loss(domain_y_true, domain_y_pred)
 
         # DA-WS regularizer
@@ -811,8 +853,7 @@ class MethodDaws(MethodDann):
         # additional P(y) label proportion information. Thus, we use it and the
         # adversarial domain-invariant FE objectives as sort of auxiliary
         # losses.
-        target = tf.where(tf.equal(domain_y_true, 0))
-        task_y_pred_target = tf.gather(task_y_pred, target)
+        target = tf.cast(tf.equal(domain_y_true, 0), tf.float32)
 
         # Idea:
         # argmax, one-hot, reduce_sum(..., axis=1), /= batch_size, KL with p_y
@@ -831,11 +872,16 @@ class MethodDaws(MethodDann):
         # the 128 batch size), then accumulate this gradient over multiple steps
         # and then apply.
         #
-        # cast batch_size to float otherwise:
-        # "x and y must have the same dtype, got tf.float32 != tf.int32"
-        batch_size = tf.cast(tf.shape(task_y_pred_target)[0], dtype=tf.float32)
-        p_y_batch = tf.reduce_sum(tf.nn.softmax(task_y_pred_target), axis=0) / batch_size
-        daws_loss = tf.keras.losses.KLD(self.p_y, p_y_batch)
+        # Only sum the target examples' softmax outputs (via the mask), and the
+        # batch size is the number of target examples. If there aren't any,
+        # then p_y_batch is all zeros (rather than NaN), which would make the
+        # KL divergence large, so instead skip the loss for this batch.
+        batch_size = tf.reduce_sum(target)
+        p_y_batch = tf.math.divide_no_nan(tf.reduce_sum(
+            tf.nn.softmax(task_y_pred) * target[:, tf.newaxis], axis=0),
+            batch_size)
+        daws_loss = tf.keras.losses.KLD(self.p_y, p_y_batch) \
+            * tf.cast(batch_size > 0, tf.float32)
 
         # Sum up individual losses for the total
         #
@@ -1374,8 +1420,6 @@ class MethodAflacDG(MethodDannDG):
         super().__init__(*args, **kwargs)
         self.loss_names = ["fe_tc", "domain", "task", "kl"]
         self.mle_for_p_d_given_y()
-        # Not fed to the model, but used in the loss
-        self.grl_schedule = models.DannGrlSchedule(self.total_steps)
 
     def mle_for_p_d_given_y(self):
         """ Compute P(d|y)
@@ -1494,10 +1538,12 @@ class MethodAflacDG(MethodDannDG):
 
     def compute_gradients(self, tape, losses, which_model):
         fe_tc_loss, d_loss, _, _ = losses
-        grad = tape.gradient(fe_tc_loss,
-            self.model[which_model].trainable_variables_task_fe)
-        d_grad = tape.gradient(d_loss,
-            self.model[which_model].trainable_variables_domain)
+        grad = self.gradient(tape, fe_tc_loss,
+            self.model[which_model].trainable_variables_task_fe,
+            self.opt[which_model]["opt"])
+        d_grad = self.gradient(tape, d_loss,
+            self.model[which_model].trainable_variables_domain,
+            self.opt[which_model]["d_opt"])
         return [grad, d_grad]
 
     def apply_gradients(self, gradients, which_model):
@@ -1515,3 +1561,17 @@ def make_loss(from_logits=True):
         return cce(y_true, y_pred)
 
     return loss
+
+
+def make_masked_loss(from_logits=True):
+    """ Cross entropy averaged over only the examples where mask is true, or
+    zero if there aren't any. Unlike gathering those examples first, the shapes
+    don't depend on how many there are. """
+    def loss(y_true, y_pred, mask):
+        per_example = tf.keras.losses.sparse_categorical_crossentropy(
+            y_true, y_pred, from_logits=from_logits)
+        mask = tf.cast(mask, per_example.dtype)
+        return tf.math.divide_no_nan(tf.reduce_sum(per_example * mask),
+            tf.reduce_sum(mask))
+
+    return loss
@@ -8,6 +8,15 @@ from vrnn import VRNN
 
 FLAGS = flags.FLAGS
 
+# Note: the last layer of each task/domain classifier is float32 (dtype="float32")
+# so that with a mixed precision policy (see --policy in main.py) the logits and
+# thus the losses are still computed in float32 for numerical stability.
+
+# The image models are all channels last (NHWC), which is what the fast cuDNN
+# fused batch norm and Tensor Core conv kernels need. Set it explicitly for
+# layers that use the default (e.g. ResNet50) in case something else changed it.
+tf.keras.backend.set_image_data_format("channels_last")
+
 models = {}
 
 
@@ -38,11 +47,12 @@ def list_models():
 @tf.custom_gradient
 def flip_gradient(x, grl_lambda):
     """ Forward pass identity, backward pass negate gradient and multiply by  """
-    grl_lambda = tf.cast(grl_lambda, dtype=tf.float32)
+    grl_lambda = tf.cast(grl_lambda, dtype=x.dtype)
 
     def grad(dy):
-        # the 0 is for grl_lambda, which doesn't have a gradient
-        return tf.negative(dy) * grl_lambda * tf.ones_like(x), 0
+        # grl_lambda is a scalar, so this already has the shape of x. The None
+        # is for grl_lambda, which doesn't have a gradient.
+        return -dy * grl_lambda, None
 
     return x, grad
 
@@ -51,30 +61,23 @@ class FlipGradient(tf.keras.layers.Layer):
     """
     Gradient reversal layer
 
-    global_step = tf.Variable storing the current step
-    schedule = a function taking the global_step and computing the grl_lambda,
-        e.g. `lambda step: 1.0` or some more complex function.
+    grl_lambda = the already-computed multiplier for the reversed gradient,
+        e.g. from a schedule like DannGrlSchedule, so the schedule is computed
+        once rather than in every gradient reversal layer
     """
-    def __init__(self, global_step, grl_schedule, **kwargs):
-        super().__init__(**kwargs)
-        self.global_step = global_step
-        self.grl_schedule = grl_schedule
-
-    def call(self, inputs, **kwargs):
-        """ Calculate grl_lambda first based on the current global step (a
-        variable) and then create the layer that does nothing except flip
-        the gradients """
-        grl_lambda = self.grl_schedule(self.global_step)
+    def call(self, inputs, grl_lambda, **kwargs):
+        """ Does nothing except flip the gradients """
         return flip_gradient(inputs, grl_lambda)
 
 
 def DannGrlSchedule(num_steps):
-    """ GRL schedule from DANN paper """
-    num_steps = tf.cast(num_steps, tf.float32)
+    """ GRL schedule from DANN paper, 2/(1+exp(-10*p))-1 for p = step/num_steps,
+    which is the same as 2*sigmoid(10*p)-1 """
+    # num_steps is fixed, so compute the scale once rather than every step
+    scale = tf.constant(10.0 / (float(num_steps) + 1.0), dtype=tf.float32)
 
     def schedule(step):
-        step = tf.cast(step, tf.float32)
-        return 2/(1+tf.exp(-10*(step/(num_steps+1))))-1
+        return 2.0*tf.math.sigmoid(scale*tf.cast(step, tf.float32)) - 1.0
 
     return schedule
 
@@ -85,6 +88,105 @@ class StopGradient(tf.keras.layers.Layer):
         return tf.stop_gradient(inputs)
 
 
+class FusedBatchNormalization(tf.keras.layers.BatchNormalization):
+    """
+    Batch normalization that always uses the fused kernel, which is much faster
+    (especially on GPU) than the non-fused version. However, fused batch norm
+    requires 4D inputs, so reshape dense [batch, features] and conv1d
+    [batch, time_steps, features] outputs to 4D before normalizing the last
+    axis and back afterwards.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(fused=True, **kwargs)
+
+    def _expand(self, inputs):
+        """ Add dimensions of size 1 after the batch dimension to make it 4D """
+        for _ in range(4 - inputs.shape.rank):
+            inputs = tf.expand_dims(inputs, axis=1)
+        return inputs
+
+    def build(self, input_shape):
+        input_shape = tf.TensorShape(input_shape)
+        assert 2 <= input_shape.rank <= 4, \
+            "FusedBatchNormalization only supports 2D, 3D, or 4D inputs"
+        shape_4d = [input_shape[0]] + [1]*(4 - input_shape.rank) \
+            + input_shape[1:].as_list()
+        super().build(tf.TensorShape(shape_4d))
+
+        # Allow the original-rank inputs, not only the 4D ones from above
+        self.input_spec = tf.keras.layers.InputSpec(min_ndim=2, max_ndim=4)
+
+    def call(self, inputs, training=None):
+        rank = inputs.shape.rank
+        outputs = super().call(self._expand(inputs), training=training)
+
+        # Remove the dimensions we added in _expand()
+        for _ in range(4 - rank):
+            outputs = tf.squeeze(outputs, axis=1)
+
+        return outputs
+
+
+def fold_batch_norm(bn, kernel, dtype):
+    """
+    At inference, batch norm is just a per-output-channel scale and shift using
+    the moving mean/variance, so fold it into the kernel of the preceding
+    (bias-free) conv or dense layer. Returns the folded kernel and bias.
+
+    BN(x*W) = gamma*(x*W - mean)/sqrt(var + eps) + beta
+            = x*(W*scale) + (beta - mean*scale)
+    where scale = gamma/sqrt(var + eps), over the last axis of the kernel
+
+    Note: the BN weights are always float32, so fold in float32 then cast to
+    dtype, the input dtype (e.g. float16 with mixed precision)
+    """
+    scale = bn.gamma * tf.math.rsqrt(bn.moving_variance + bn.epsilon)
+    folded_kernel = tf.cast(kernel, scale.dtype) * scale
+    bias = bn.beta - bn.moving_mean * scale
+    return tf.cast(folded_kernel, dtype), tf.cast(bias, dtype)
+
+
+class ConvBNAct(tf.keras.layers.Layer):
+    """
+    Conv2D followed by batch norm and an activation (e.g. ReLU)
+
+    When training, this is the same as the three separate layers. At inference,
+    the batch norm is just a per-channel scale and shift of the conv output
+    using the moving mean/variance, so fold it into the conv weights and bias,
+    i.e. a single conv followed by the activation.
+    """
+    def __init__(self, filters, kernel_size, strides, padding, activation,
+            **kwargs):
+        super().__init__(**kwargs)
+        self.conv = tf.keras.layers.Conv2D(filters, kernel_size, strides,
+            padding, data_format="channels_last",
+            use_bias=False)  # BN has a bias term
+        self.bn = FusedBatchNormalization()
+        self.act = activation
+
+    def build(self, input_shape):
+        # Build the conv and BN here since at inference we don't call them, so
+        # they wouldn't otherwise be built if inference happens first
+        with tf.name_scope(self.conv.name):
+            self.conv.build(input_shape)
+        with tf.name_scope(self.bn.name):
+            self.bn.build(self.conv.compute_output_shape(input_shape))
+        super().build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training:
+            net = self.conv(inputs)
+            net = self.bn(net, training=training)
+        else:
+            kernel, bias = fold_batch_norm(self.bn, self.conv.kernel,
+                inputs.dtype)
+            net = tf.nn.conv2d(inputs, kernel, strides=self.conv.strides,
+                padding=self.conv.padding.upper(), data_format="NHWC")
+            net = tf.nn.bias_add(net, bias, data_format="NHWC")
+
+        return self.act(net)
+
+
 class ModelBase(tf.keras.Model):
     """ Base model class (inheriting from Keras' Model class) """
     def __init__(self, *args, **kwargs):
@@ -134,19 +236,10 @@ class ModelBase(tf.keras.Model):
         """ Returns all trainable variables in the model """
         return self.trainable_variables_task_fe_domain
 
-    def set_learning_phase(self, training):
-        # Manually set the learning phase since we probably aren't using .fit()
-        # but layers like batch norm and dropout still need to know if
-        # training/testing
-        if training is True:
-            tf.keras.backend.set_learning_phase(1)
-        elif training is False:
-            tf.keras.backend.set_learning_phase(0)
-
     # Allow easily overriding each part of the call() function, without having
     # to override call() in its entirety
     def call_feature_extractor(self, inputs, which_fe=None, which_tc=None,
-            which_dc=None, **kwargs):
+            which_dc=None, grl_lambda=None, **kwargs):
         if which_fe is not None:
             assert isinstance(self.feature_extractor, list)
             return self.feature_extractor[which_fe](inputs, **kwargs)
@@ -154,7 +247,7 @@ class ModelBase(tf.keras.Model):
         return self.feature_extractor(inputs, **kwargs)
 
     def call_task_classifier(self, fe, which_fe=None, which_tc=None,
-            which_dc=None, **kwargs):
+            which_dc=None, grl_lambda=None, **kwargs):
         if which_tc is not None:
             assert isinstance(self.task_classifier, list)
             return self.task_classifier[which_tc](fe, **kwargs)
@@ -162,7 +255,7 @@ class ModelBase(tf.keras.Model):
         return self.task_classifier(fe, **kwargs)
 
     def call_domain_classifier(self, fe, task, which_fe=None, which_tc=None,
-            which_dc=None, **kwargs):
+            which_dc=None, grl_lambda=None, **kwargs):
         if which_dc is not None:
             assert isinstance(self.domain_classifier, list)
             return self.domain_classifier[which_dc](fe, **kwargs)
@@ -170,10 +263,13 @@ class ModelBase(tf.keras.Model):
         return self.domain_classifier(fe, **kwargs)
 
     def call(self, inputs, training=None, **kwargs):
-        self.set_learning_phase(training)
-        fe = self.call_feature_extractor(inputs, **kwargs)
-        task = self.call_task_classifier(fe, **kwargs)
-        domain = self.call_domain_classifier(fe, task, **kwargs)
+        # Pass training through to each part rather than setting the global
+        # learning phase, since layers like batch norm and dropout need to know
+        # if training/testing
+        fe = self.call_feature_extractor(inputs, training=training, **kwargs)
+        task = self.call_task_classifier(fe, training=training, **kwargs)
+        domain = self.call_domain_classifier(fe, task, training=training,
+            **kwargs)
         return task, domain, fe
 
 
@@ -206,7 +302,7 @@ class CodatsModelMakerBase(ModelMakerBase):
     of these models """
     def make_task_classifier(self, num_classes, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
@@ -215,16 +311,16 @@ class CodatsModelMakerBase(ModelMakerBase):
             # https://arxiv.org/pdf/1902.09820.pdf They say dropout of 0.7 but
             # I'm not sure if that means 1-0.7 = 0.3 or 0.7 itself.
             tf.keras.layers.Dense(500, use_bias=False),
-            tf.keras.layers.BatchNormalization(),
+            FusedBatchNormalization(),
             tf.keras.layers.Activation("relu"),
             tf.keras.layers.Dropout(0.3),
 
             tf.keras.layers.Dense(500, use_bias=False),
-            tf.keras.layers.BatchNormalization(),
+            FusedBatchNormalization(),
             tf.keras.layers.Activation("relu"),
             tf.keras.layers.Dropout(0.3),
 
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
@@ -264,17 +360,17 @@ class FcnModelMaker(CodatsModelMakerBase):
             return tf.keras.Sequential([
                 tf.keras.layers.Conv1D(filters=128, kernel_size=8, padding="same",
                     use_bias=False),
-                tf.keras.layers.BatchNormalization(),
+                FusedBatchNormalization(),
                 tf.keras.layers.Activation("relu"),
 
                 tf.keras.layers.Conv1D(filters=256, kernel_size=5, padding="same",
                     use_bias=False),
-                tf.keras.layers.BatchNormalization(),
+                FusedBatchNormalization(),
                 tf.keras.layers.Activation("relu"),
 
                 tf.keras.layers.Conv1D(filters=128, kernel_size=3, padding="same",
                     use_bias=False),
-                tf.keras.layers.BatchNormalization(),
+                FusedBatchNormalization(),
                 tf.keras.layers.Activation("relu"),
 
                 tf.keras.layers.GlobalAveragePooling1D(),
@@ -327,7 +423,7 @@ class InceptionModule(tf.keras.layers.Layer):
 
         # Step 3 -- concatenate along feature dimension (axis=2 or axis=-1)
         self.concat = tf.keras.layers.Concatenate(axis=-1)
-        self.bn = tf.keras.layers.BatchNormalization()
+        self.bn = FusedBatchNormalization()
         self.act = tf.keras.layers.Activation(activation)
 
     # def get_config(self):
@@ -378,15 +474,15 @@ class InceptionShortcut(tf.keras.layers.Layer):
 
         self.shortcut_conv1d = tf.keras.layers.Conv1D(filters=output_filters,
             kernel_size=1, padding="same", use_bias=False)
-        self.shortcut_bn = tf.keras.layers.BatchNormalization()
+        self.shortcut_bn = FusedBatchNormalization()
         self.shortcut_add = tf.keras.layers.Add()
 
     def call(self, inputs, **kwargs):
         Z_residual, Z_inception = inputs
 
         # Create shortcut connection
-        Z_shortcut = self.shortcut_conv1d(Z_residual)
-        Z_shortcut = self.shortcut_bn(Z_shortcut)
+        Z_shortcut = self.shortcut_conv1d(Z_residual, **kwargs)
+        Z_shortcut = self.shortcut_bn(Z_shortcut, **kwargs)
 
         # Add shortcut to Inception
         return self.shortcut_add([Z_shortcut, Z_inception])
@@ -455,13 +551,61 @@ class InceptionTimeModelMaker(CodatsModelMakerBase):
                 "currently only FCN works with --share_most_weights")
 
 
+class DenseBnReluDropout(tf.keras.layers.Layer):
+    """
+    Dense (no bias since BN has a bias term) followed by fused batch norm,
+    ReLU, and dropout as one layer, calling ReLU and dropout directly rather
+    than as separate Keras layers, so there's less overhead and it's easier for
+    XLA to fuse them
+
+    Like ConvBNAct, at inference the batch norm is folded into the kernel and a
+    bias, i.e. a single matmul plus bias followed by the ReLU.
+    """
+    def __init__(self, units, dropout, **kwargs):
+        super().__init__(**kwargs)
+        self.dense = tf.keras.layers.Dense(units,
+            use_bias=False)  # BN has a bias term
+        self.bn = FusedBatchNormalization()
+        self.dropout = dropout
+
+    def build(self, input_shape):
+        # Build the dense and BN here since at inference we don't call them, so
+        # they wouldn't otherwise be built if inference happens first
+        with tf.name_scope(self.dense.name):
+            self.dense.build(input_shape)
+        with tf.name_scope(self.bn.name):
+            self.bn.build(self.dense.compute_output_shape(input_shape))
+        super().build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training:
+            net = self.dense(inputs)
+            net = self.bn(net, training=training)
+        else:
+            kernel, bias = fold_batch_norm(self.bn, self.dense.kernel,
+                inputs.dtype)
+            net = tf.matmul(inputs, kernel)
+            net = tf.nn.bias_add(net, bias)
+
+        net = tf.nn.relu(net)
+
+        if training and self.dropout != 0:
+            net = tf.nn.dropout(net, rate=self.dropout)
+
+        return net
+
+
+def make_dropout(rate):
+    """ List of the dropout layer to add to a list of layers, or if the rate is
+    zero, then an empty list since the layer would do nothing """
+    if rate == 0:
+        return []
+
+    return [tf.keras.layers.Dropout(rate)]
+
+
 def make_dense_bn_dropout(units, dropout):
-    return tf.keras.Sequential([
-        tf.keras.layers.Dense(units, use_bias=False),  # BN has a bias term
-        tf.keras.layers.BatchNormalization(),
-        tf.keras.layers.Activation("relu"),
-        tf.keras.layers.Dropout(dropout),
-    ])
+    return DenseBnReluDropout(units, dropout)
 
 
 def make_dense_ln_dropout(units, dropout):
@@ -469,8 +613,7 @@ def make_dense_ln_dropout(units, dropout):
         tf.keras.layers.Dense(units, use_bias=False),  # BN has a bias term
         tf.keras.layers.LayerNormalization(),
         tf.keras.layers.Activation("relu"),
-        tf.keras.layers.Dropout(dropout),
-    ])
+    ] + make_dropout(dropout))
 
 
 @register_model("mlp")
@@ -496,7 +639,7 @@ class MlpModelMaker(CodatsModelMakerBase):
         return tf.keras.Sequential([
             tf.keras.layers.Dense(500, activation="relu"),
             tf.keras.layers.Dropout(0.3),
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
 
@@ -548,20 +691,15 @@ class ResnetBlock(tf.keras.layers.Layer):
     def __init__(self, units, dropout, layers, layer_norm=False, **kwargs):
         super().__init__(**kwargs)
         if layer_norm:
-            self.blocks = [make_dense_ln_dropout(units, dropout) for _ in range(layers)]
+            self.block = tf.keras.Sequential([
+                make_dense_ln_dropout(units, dropout) for _ in range(layers)])
         else:
-            self.blocks = [make_dense_bn_dropout(units, dropout) for _ in range(layers)]
-        self.add = tf.keras.layers.Add()
+            self.block = tf.keras.Sequential([
+                make_dense_bn_dropout(units, dropout) for _ in range(layers)])
 
     def call(self, inputs, **kwargs):
         """ Like Sequential but with a residual connection """
-        shortcut = inputs
-        net = inputs
-
-        for block in self.blocks:
-            net = block(net, **kwargs)
-
-        return self.add([shortcut, net], **kwargs)
+        return inputs + self.block(inputs, **kwargs)
 
 
 class WangResnetBlock(tf.keras.layers.Layer):
@@ -571,7 +709,7 @@ class WangResnetBlock(tf.keras.layers.Layer):
     """
     def __init__(self, n_feature_maps, shortcut_resize=True,
             kernel_sizes=[8, 5, 3], reflect_padding=False,
-            normalization=tf.keras.layers.BatchNormalization,
+            normalization=FusedBatchNormalization,
             activation="relu", **kwargs):
         super().__init__(**kwargs)
         self.blocks = []
@@ -660,7 +798,7 @@ class TimeNetModelMaker(ModelMakerBase):
             make_dense_bn_dropout(self.units, self.dropout)
             for _ in range(layers-1)
         ]
-        last = [tf.keras.layers.Dense(num_outputs)]
+        last = [tf.keras.layers.Dense(num_outputs, dtype="float32")]
         return tf.keras.Sequential(layers + last)
 
     def make_feature_extractor(self, **kwargs):
@@ -693,10 +831,12 @@ class DannMnistModelMaker(ModelMakerBase):
     """ Figure 4(a) MNIST architecture -- Ganin et al. DANN JMLR 2016 paper """
     def make_feature_extractor(self, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Conv2D(32, (5, 5), (1, 1), "valid", activation="relu"),
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid"),
-            tf.keras.layers.Conv2D(48, (5, 5), (1, 1), "valid", activation="relu"),
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid"),
+            tf.keras.layers.Conv2D(32, (5, 5), (1, 1), "valid", "channels_last",
+                activation="relu"),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid", "channels_last"),
+            tf.keras.layers.Conv2D(48, (5, 5), (1, 1), "valid", "channels_last",
+                activation="relu"),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid", "channels_last"),
             tf.keras.layers.Flatten(),
         ])
 
@@ -704,13 +844,13 @@ class DannMnistModelMaker(ModelMakerBase):
         return tf.keras.Sequential([
             tf.keras.layers.Dense(100, "relu"),
             tf.keras.layers.Dense(100, "relu"),
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
         return tf.keras.Sequential([
             tf.keras.layers.Dense(100, "relu"),
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
@@ -723,55 +863,28 @@ class DannSvhnModelMaker(ModelMakerBase):
 
     def make_feature_extractor(self, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Conv2D(64, (5, 5), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-
-            tf.keras.layers.MaxPool2D((3, 3), (2, 2), "same"),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Conv2D(64, (5, 5), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-
-            tf.keras.layers.MaxPool2D((3, 3), (2, 2), "same"),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Conv2D(128, (5, 5), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-
+            ConvBNAct(64, (5, 5), (1, 1), "same", tf.keras.layers.ReLU()),
+            tf.keras.layers.MaxPool2D((3, 3), (2, 2), "same", "channels_last"),
+        ] + make_dropout(self.dropout) + [
+            ConvBNAct(64, (5, 5), (1, 1), "same", tf.keras.layers.ReLU()),
+            tf.keras.layers.MaxPool2D((3, 3), (2, 2), "same", "channels_last"),
+        ] + make_dropout(self.dropout) + [
+            ConvBNAct(128, (5, 5), (1, 1), "same", tf.keras.layers.ReLU()),
             tf.keras.layers.Flatten(),
         ])
 
     def make_task_classifier(self, num_classes, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Dense(3072),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Dense(2048),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Dense(num_classes),
+            make_dense_bn_dropout(3072, self.dropout),
+            make_dense_bn_dropout(2048, self.dropout),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Dense(1024),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Dense(1024),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.ReLU(),
-            tf.keras.layers.Dropout(self.dropout),
-
-            tf.keras.layers.Dense(num_domains),
+            make_dense_bn_dropout(1024, self.dropout),
+            make_dense_bn_dropout(1024, self.dropout),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
@@ -780,29 +893,55 @@ class DannGtsrbModelMaker(ModelMakerBase):
     """ Figure 4(c) SVHN architecture -- Ganin et al. DANN JMLR 2016 paper """
     def make_feature_extractor(self, **kwargs):
         return tf.keras.Sequential([
-            tf.keras.layers.Conv2D(96, (5, 5), (1, 1), "valid", activation="relu"),
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid"),
-            tf.keras.layers.Conv2D(144, (3, 3), (1, 1), "valid", activation="relu"),
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid"),
-            tf.keras.layers.Conv2D(256, (5, 5), (1, 1), "valid", activation="relu"),
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid"),
+            tf.keras.layers.Conv2D(96, (5, 5), (1, 1), "valid", "channels_last",
+                activation="relu"),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid", "channels_last"),
+            tf.keras.layers.Conv2D(144, (3, 3), (1, 1), "valid", "channels_last",
+                activation="relu"),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid", "channels_last"),
+            tf.keras.layers.Conv2D(256, (5, 5), (1, 1), "valid", "channels_last",
+                activation="relu"),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "valid", "channels_last"),
             tf.keras.layers.Flatten(),
         ])
 
     def make_task_classifier(self, num_classes, **kwargs):
         return tf.keras.Sequential([
             tf.keras.layers.Dense(512, "relu"),
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
         return tf.keras.Sequential([
             tf.keras.layers.Dense(1024, "relu"),
             tf.keras.layers.Dense(1024, "relu"),
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
+class DropoutGaussian(tf.keras.layers.Layer):
+    """
+    Dropout followed by additive Gaussian noise (like Dropout then
+    GaussianNoise) in one layer, so it's one elementwise pass over the input:
+    x*mask/(1-rate) + noise when training, x otherwise
+    """
+    def __init__(self, rate, stddev, **kwargs):
+        super().__init__(**kwargs)
+        self.rate = rate
+        self.stddev = stddev
+
+    def call(self, inputs, training=None):
+        if not training:
+            return inputs
+
+        shape = tf.shape(inputs)
+        keep = tf.random.uniform(shape, dtype=inputs.dtype) >= self.rate
+        scale = tf.cast(keep, inputs.dtype) / (1 - self.rate)
+        noise = tf.random.normal(shape, stddev=self.stddev, dtype=inputs.dtype)
+
+        return inputs*scale + noise
+
+
 class VadaModelMakerBase(ModelMakerBase):
     """ Table 6 Small CNN -- Shu et al. VADA / DIRT-T ICLR 2018 paper
     Note: they used small for digits, traffic signs, and WiFi and large for
@@ -814,24 +953,18 @@ class VadaModelMakerBase(ModelMakerBase):
 
     def _conv_blocks(self, depth):
         return [
-            tf.keras.layers.Conv2D(depth, (3, 3), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.LeakyReLU(self.leak_alpha),
-
-            tf.keras.layers.Conv2D(depth, (3, 3), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.LeakyReLU(self.leak_alpha),
-
-            tf.keras.layers.Conv2D(depth, (3, 3), (1, 1), "same"),
-            tf.keras.layers.BatchNormalization(),
-            tf.keras.layers.LeakyReLU(self.leak_alpha),
+            ConvBNAct(depth, (3, 3), (1, 1), "same",
+                tf.keras.layers.LeakyReLU(self.leak_alpha)),
+            ConvBNAct(depth, (3, 3), (1, 1), "same",
+                tf.keras.layers.LeakyReLU(self.leak_alpha)),
+            ConvBNAct(depth, (3, 3), (1, 1), "same",
+                tf.keras.layers.LeakyReLU(self.leak_alpha)),
         ]
 
     def _pool_blocks(self):
         return [
-            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "same"),
-            tf.keras.layers.Dropout(0.5),
-            tf.keras.layers.GaussianNoise(1),
+            tf.keras.layers.MaxPool2D((2, 2), (2, 2), "same", "channels_last"),
+            DropoutGaussian(0.5, 1),
         ]
 
     def make_feature_extractor(self, **kwargs):
@@ -845,9 +978,9 @@ class VadaModelMakerBase(ModelMakerBase):
         return tf.keras.Sequential(
             self._conv_blocks(64 if self.small else 192)
             + [
-                tf.keras.layers.GlobalAvgPool2D(),
+                tf.keras.layers.GlobalAvgPool2D(data_format="channels_last"),
                 tf.keras.layers.Flatten(),
-                tf.keras.layers.Dense(num_classes),
+                tf.keras.layers.Dense(num_classes, dtype="float32"),
             ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
@@ -855,10 +988,10 @@ class VadaModelMakerBase(ModelMakerBase):
             tf.keras.layers.Flatten(),
 
             tf.keras.layers.Dense(100),
-            tf.keras.layers.BatchNormalization(),
+            FusedBatchNormalization(),
             tf.keras.layers.ReLU(),
 
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
@@ -885,13 +1018,13 @@ class ResNet50ModelMaker(ModelMakerBase):
     def make_task_classifier(self, num_classes, **kwargs):
         return tf.keras.Sequential([
             tf.keras.layers.Flatten(),
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
 
     def make_domain_classifier(self, num_domains, **kwargs):
         return tf.keras.Sequential([
             tf.keras.layers.Flatten(),
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
 
@@ -960,12 +1093,22 @@ class DannModelBase:
     def __init__(self, num_classes, num_domains, global_step,
             total_steps, **kwargs):
         super().__init__(num_classes, num_domains, **kwargs)
-        grl_schedule = DannGrlSchedule(total_steps)
-        self.flip_gradient = FlipGradient(global_step, grl_schedule)
+        self.global_step = global_step
+        self.grl_schedule = DannGrlSchedule(total_steps)
+        self.flip_gradient = FlipGradient()
+
+    def call(self, inputs, grl_lambda=None, **kwargs):
+        """ Compute the GRL schedule once per call based on the current global
+        step (a variable), unless already given (during training the method
+        computes it once per step, see MethodDann.train_model_kwargs) """
+        if grl_lambda is None:
+            grl_lambda = self.grl_schedule(self.global_step)
 
-    def call_domain_classifier(self, fe, task, **kwargs):
+        return super().call(inputs, grl_lambda=grl_lambda, **kwargs)
+
+    def call_domain_classifier(self, fe, task, grl_lambda=None, **kwargs):
         # Pass FE output through GRL then to DC
-        grl_output = self.flip_gradient(fe, **kwargs)
+        grl_output = self.flip_gradient(fe, grl_lambda, **kwargs)
         return super().call_domain_classifier(grl_output, task, **kwargs)
 
 
@@ -991,14 +1134,14 @@ class SleepModel(DannModelBase, CnnModelBase):
         self.concat = tf.keras.layers.Concatenate(axis=1)
         self.stop_gradient = StopGradient()
 
-    def call_domain_classifier(self, fe, task, **kwargs):
+    def call_domain_classifier(self, fe, task, grl_lambda=None, **kwargs):
         # We could support this but it's awkward since we want to call the super's
         # super's call_domain_classifier but not the super's version...
         assert not isinstance(self.domain_classifier, list), \
             "currently do not support SleepModel with multiple domain classifiers"
 
         # Pass FE output through GRL and append stop-gradient-ed task output too
-        grl_output = self.flip_gradient(fe, **kwargs)
+        grl_output = self.flip_gradient(fe, grl_lambda, **kwargs)
         task_stop_gradient = self.stop_gradient(task)
         domain_input = self.concat([grl_output, task_stop_gradient])
         return self.domain_classifier(domain_input, **kwargs)
@@ -1063,23 +1206,23 @@ class RnnModelBase(ModelBase):
             tf.keras.layers.Dense(50),
             tf.keras.layers.Dense(50),
             tf.keras.layers.Dense(50),
-            tf.keras.layers.Dense(num_classes),
+            tf.keras.layers.Dense(num_classes, dtype="float32"),
         ])
         self.domain_classifier = tf.keras.Sequential([
             tf.keras.layers.Dense(50),
             tf.keras.layers.Dense(50),
             tf.keras.layers.Dense(50),
-            tf.keras.layers.Dense(num_domains),
+            tf.keras.layers.Dense(num_domains, dtype="float32"),
         ])
 
     def call(self, inputs, training=None, **kwargs):
         """ Since our RNN feature extractor returns two values (output and
         RNN state, which we need for the loss) we need to only pass the output
         to the classifiers, i.e. fe[0] rather than fe """
-        self.set_learning_phase(training)
-        fe = self.call_feature_extractor(inputs, **kwargs)
-        task = self.call_task_classifier(fe[0], **kwargs)
-        domain = self.call_domain_classifier(fe[0], task, **kwargs)
+        fe = self.call_feature_extractor(inputs, training=training, **kwargs)
+        task = self.call_task_classifier(fe[0], training=training, **kwargs)
+        domain = self.call_domain_classifier(fe[0], task, training=training,
+            **kwargs)
         return task, domain, fe
 
 